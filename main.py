@@ -1,5 +1,6 @@
 import logging
 import os
+import re
 import asyncio
 from datetime import datetime, date, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
@@ -70,7 +71,7 @@ def normalize_brazilian_phone(phone_number: str) -> str:
 # Import configurations and services
 from config import Config
 from services.database_service import db_service
-from services.scheduler_service import scheduler_service
+from services.scheduler_service import scheduler_service, WHATSAPP_SEND_WORKERS
 from services.whatsapp_service import whatsapp_service
 from services.payment_service import payment_service
 from models import User, Client, Subscription, MessageTemplate, MessageLog
@@ -510,9 +511,9 @@ async def force_process_reminders_today(update: Update, context: ContextTypes.DE
             
             session.commit()
             
-            # Force process reminders now
+            # Force process reminders now (worker thread: the sends are blocking HTTP)
             from services.scheduler_service import scheduler_service
-            scheduler_service._process_daily_reminders_sync(db_user.id)
+            await asyncio.to_thread(scheduler_service._process_daily_reminders_sync, db_user.id)
             
             await update.message.reply_text("""✅ **Lembretes Processados!**
 
@@ -579,6 +580,49 @@ O que deseja fazer?
         elif update.callback_query and update.callback_query.message:
             await update.callback_query.message.reply_text("❌ Erro ao carregar menu.")
 
+def get_dashboard_totals(session, user_id, today, month_start, month_end):
+    """Dashboard counts and sums in one aggregate query (no Client rows loaded)"""
+    from sqlalchemy import and_, or_, case, func
+    
+    active = Client.status == 'active'
+    price = func.coalesce(Client.plan_price, 0)
+    # 1. VALORES RECEBIDOS (Clientes que pagaram no mês atual)
+    received = and_(active, Client.last_payment_date >= month_start, Client.last_payment_date <= month_end)
+    # 2. VALORES A RECEBER (vencem de hoje até o fim do mês e não pagaram este mês)
+    pending = and_(
+        active, Client.due_date >= today, Client.due_date <= month_end,
+        or_(Client.last_payment_date.is_(None), Client.last_payment_date < month_start)
+    )
+    # 3. VALORES EM ATRASO (vencidos e que não pagaram após o vencimento)
+    unpaid_after_due = or_(Client.last_payment_date.is_(None), Client.last_payment_date < Client.due_date)
+    overdue = and_(active, Client.due_date < today, unpaid_after_due)
+    # Atrasados que venceram no mês vigente (para o total do mês)
+    overdue_this_month = and_(active, Client.due_date >= month_start, Client.due_date < today, unpaid_after_due)
+    
+    row = session.query(
+        func.count(case((received, 1))),
+        func.coalesce(func.sum(case((received, price), else_=0)), 0),
+        func.count(case((pending, 1))),
+        func.coalesce(func.sum(case((pending, price), else_=0)), 0),
+        func.count(case((overdue, 1))),
+        func.coalesce(func.sum(case((overdue, price), else_=0)), 0),
+        func.coalesce(func.sum(case((overdue_this_month, price), else_=0)), 0),
+        func.count(Client.id),
+        func.count(case((active, 1))),
+    ).filter(Client.user_id == user_id).one()
+    
+    return {
+        'received_count': row[0],
+        'received_total': float(row[1]),
+        'pending_count': row[2],
+        'pending_total': float(row[3]),
+        'overdue_count': row[4],
+        'overdue_total': float(row[5]),
+        'overdue_this_month_total': float(row[6]),
+        'total_clients': row[7],
+        'active_clients': row[8],
+    }
+
 async def dashboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle dashboard callback - Clear financial overview"""
     if not update.callback_query or not update.callback_query.from_user:
@@ -600,77 +644,22 @@ async def dashboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             # Get current month info
             today = date.today()
             from calendar import monthrange
-            from sqlalchemy import and_, or_
             current_year = today.year
             current_month = today.month
             month_start = date(current_year, current_month, 1)
             month_end = date(current_year, current_month, monthrange(current_year, current_month)[1])
             
-            # 1. VALORES RECEBIDOS (Clientes que pagaram no mês atual)
-            received_clients = session.query(Client).filter(
-                and_(
-                    Client.user_id == db_user.id,
-                    Client.status == 'active',
-                    Client.last_payment_date >= month_start,
-                    Client.last_payment_date <= month_end
-                )
-            ).all()
-            
-            received_count = len(received_clients)
-            received_total = sum(client.plan_price or 0 for client in received_clients)
-            
-            # 2. VALORES A RECEBER (Clientes que vencem hoje ou no futuro e não pagaram este mês)
-            pending_clients = session.query(Client).filter(
-                and_(
-                    Client.user_id == db_user.id,
-                    Client.status == 'active',
-                    Client.due_date >= today,  # Apenas vencimentos de hoje em diante
-                    Client.due_date <= month_end,
-                    or_(
-                        Client.last_payment_date.is_(None),
-                        Client.last_payment_date < month_start  # Não pagou neste mês
-                    )
-                )
-            ).all()
-            
-            pending_count = len(pending_clients)
-            pending_total = sum(client.plan_price or 0 for client in pending_clients)
-            
-            # 3. VALORES EM ATRASO (Clientes vencidos e que não pagaram)
-            overdue_clients = session.query(Client).filter(
-                and_(
-                    Client.user_id == db_user.id,
-                    Client.status == 'active',
-                    Client.due_date < today,  # Já venceu
-                    or_(
-                        Client.last_payment_date.is_(None),
-                        Client.last_payment_date < Client.due_date  # Não pagou após o vencimento
-                    )
-                )
-            ).all()
-            
-            overdue_count = len(overdue_clients)
-            overdue_total = sum(client.plan_price or 0 for client in overdue_clients)
-            
-            # Valores em atraso que faziam parte do mês vigente (para total correto)
-            overdue_this_month_clients = session.query(Client).filter(
-                and_(
-                    Client.user_id == db_user.id,
-                    Client.status == 'active',
-                    Client.due_date >= month_start,
-                    Client.due_date < today,  # Venceram neste mês
-                    or_(
-                        Client.last_payment_date.is_(None),
-                        Client.last_payment_date < Client.due_date
-                    )
-                )
-            ).all()
-            
-            overdue_this_month_total = sum(client.plan_price or 0 for client in overdue_this_month_clients)
-            
-            # Estatísticas gerais
-            total_clients = session.query(Client).filter_by(user_id=db_user.id).count()
-            active_clients = session.query(Client).filter_by(user_id=db_user.id, status='active').count()
+            # Todos os totais do dashboard numa única consulta agregada
+            totals = get_dashboard_totals(session, db_user.id, today, month_start, month_end)
+            received_count = totals['received_count']
+            received_total = totals['received_total']
+            pending_count = totals['pending_count']
+            pending_total = totals['pending_total']
+            overdue_count = totals['overdue_count']
+            overdue_total = totals['overdue_total']
+            overdue_this_month_total = totals['overdue_this_month_total']
+            total_clients = totals['total_clients']
+            active_clients = totals['active_clients']
             
             # Total do mês vigente (inclui atrasados que venceram neste mês)
             month_total = received_total + pending_total + overdue_this_month_total
@@ -2127,8 +2116,7 @@ async def handle_pairing_phone_number(update: Update, context: ContextTypes.DEFA
         # Show progress message
         progress_msg = await update.message.reply_text("🔄 Gerando código de pareamento...")
         
-        # Request pairing code
-        whatsapp_service = WhatsAppService()
+        # Request pairing code (module-level singleton)
         result = whatsapp_service.request_pairing_code(user.id, normalized_phone)
         
         if result.get('success'):
@@ -2958,6 +2946,9 @@ Obrigado pela renovação! 🎉"""
         }
     }
 
+# Variáveis aceitas nos templates; substituídas numa única passada por re.sub
+TEMPLATE_VARIABLE_RE = re.compile(r'\{(?:nome|plano|valor|vencimento|servidor|informacoes_extras)\}')
+
 def replace_template_variables(template_content, client):
     """Replace template variables with client data"""
     from datetime import date
@@ -2971,10 +2962,8 @@ def replace_template_variables(template_content, client):
         '{informacoes_extras}': client.other_info or ''
     }
     
-    # Replace all variables
-    result = template_content
-    for var, value in variables.items():
-        result = result.replace(var, str(value))
+    # Replace all variables in a single pass
+    result = TEMPLATE_VARIABLE_RE.sub(lambda m: str(variables[m.group(0)]), template_content)
     
     # Remove empty lines for informacoes_extras when empty
     if not client.other_info:
@@ -4113,77 +4102,22 @@ async def dashboard_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Get current month info
             today = date.today()
             from calendar import monthrange
-            from sqlalchemy import and_, or_
             current_year = today.year
             current_month = today.month
             month_start = date(current_year, current_month, 1)
             month_end = date(current_year, current_month, monthrange(current_year, current_month)[1])
             
-            # 1. VALORES RECEBIDOS (Clientes que pagaram no mês atual)
-            received_clients = session.query(Client).filter(
-                and_(
-                    Client.user_id == db_user.id,
-                    Client.status == 'active',
-                    Client.last_payment_date >= month_start,
-                    Client.last_payment_date <= month_end
-                )
-            ).all()
-            
-            received_count = len(received_clients)
-            received_total = sum(client.plan_price or 0 for client in received_clients)
-            
-            # 2. VALORES A RECEBER (Clientes que vencem hoje ou no futuro e não pagaram este mês)
-            pending_clients = session.query(Client).filter(
-                and_(
-                    Client.user_id == db_user.id,
-                    Client.status == 'active',
-                    Client.due_date >= today,  # Apenas vencimentos de hoje em diante
-                    Client.due_date <= month_end,
-                    or_(
-                        Client.last_payment_date.is_(None),
-                        Client.last_payment_date < month_start  # Não pagou neste mês
-                    )
-                )
-            ).all()
-            
-            pending_count = len(pending_clients)
-            pending_total = sum(client.plan_price or 0 for client in pending_clients)
-            
-            # 3. VALORES EM ATRASO (Clientes vencidos e que não pagaram)
-            overdue_clients = session.query(Client).filter(
-                and_(
-                    Client.user_id == db_user.id,
-                    Client.status == 'active',
-                    Client.due_date < today,  # Já venceu
-                    or_(
-                        Client.last_payment_date.is_(None),
-                        Client.last_payment_date < Client.due_date  # Não pagou após o vencimento
-                    )
-                )
-            ).all()
-            
-            overdue_count = len(overdue_clients)
-            overdue_total = sum(client.plan_price or 0 for client in overdue_clients)
-            
-            # Valores em atraso que faziam parte do mês vigente (para total correto)
-            overdue_this_month_clients = session.query(Client).filter(
-                and_(
-                    Client.user_id == db_user.id,
-                    Client.status == 'active',
-                    Client.due_date >= month_start,
-                    Client.due_date < today,  # Venceram neste mês
-                    or_(
-                        Client.last_payment_date.is_(None),
-                        Client.last_payment_date < Client.due_date
-                    )
-                )
-            ).all()
-            
-            overdue_this_month_total = sum(client.plan_price or 0 for client in overdue_this_month_clients)
-            
-            # Estatísticas gerais
-            total_clients = session.query(Client).filter_by(user_id=db_user.id).count()
-            active_clients = session.query(Client).filter_by(user_id=db_user.id, status='active').count()
+            # Todos os totais do dashboard numa única consulta agregada
+            totals = get_dashboard_totals(session, db_user.id, today, month_start, month_end)
+            received_count = totals['received_count']
+            received_total = totals['received_total']
+            pending_count = totals['pending_count']
+            pending_total = totals['pending_total']
+            overdue_count = totals['overdue_count']
+            overdue_total = totals['overdue_total']
+            overdue_this_month_total = totals['overdue_this_month_total']
+            total_clients = totals['total_clients']
+            active_clients = totals['active_clients']
             
             # Total do mês vigente (inclui atrasados que venceram neste mês)
             month_total = received_total + pending_total + overdue_this_month_total
@@ -4785,9 +4719,6 @@ async def send_template_to_client_callback(update: Update, context: ContextTypes
                 await query.edit_message_text("❌ Cliente ou template não encontrado.")
                 return
             
-            # Prepare template content with variables
-            message_content = template.content
-            
             # Replace variables in template
             variables = {
                 '{nome}': client.name,
@@ -4798,8 +4729,7 @@ async def send_template_to_client_callback(update: Update, context: ContextTypes
                 '{informacoes_extras}': client.other_info or 'N/A'
             }
             
-            for var, value in variables.items():
-                message_content = message_content.replace(var, value)
+            message_content = TEMPLATE_VARIABLE_RE.sub(lambda m: variables[m.group(0)], template.content)
             
             # Send WhatsApp message
             from services.whatsapp_service import whatsapp_service
@@ -4874,9 +4804,8 @@ async def template_create_new_callback(update: Update, context: ContextTypes.DEF
             logger.warning(f"DEBUG: Template creation initialized for user {user.id}, step=name")
             
     except Exception as e:
-        logger.error(f"CRITICAL ERROR in template_create_new_callback: {e}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        # logger.exception keeps the traceback at any level; it is formatted only if emitted
+        logger.exception("CRITICAL ERROR in template_create_new_callback: %s", e)
         try:
             await query.edit_message_text("❌ Erro ao iniciar criação do template.")
         except:
@@ -6164,13 +6093,9 @@ Todos os lembretes serão enviados nos horários configurados."""
 async def manual_sync_queue(user_id: int):
     """Execute manual sync for user's queue"""
     try:
-        from services.database_service import DatabaseService
-        from services.whatsapp_service import whatsapp_service
-        from models import Client, MessageTemplate, MessageLog
-        from datetime import date, timedelta
-        import asyncio
+        from models import Client, MessageLog
+        from sqlalchemy import insert
         
-        db_service = DatabaseService()
         result = {
             'success': False,
             'clients_checked': 0,
@@ -6179,6 +6104,7 @@ async def manual_sync_queue(user_id: int):
             'error': None
         }
         
+        # 1) Read and render in one short session; no DB connection is held while sending
         with db_service.get_session() as session:
             user = session.query(User).filter_by(id=user_id, is_active=True).first()
             
@@ -6186,7 +6112,9 @@ async def manual_sync_queue(user_id: int):
                 result['error'] = 'Usuário não encontrado ou inativo'
                 return result
             
-            today = date.today()
+            # One clock read per run: shared by the bucket math and every log row
+            now = datetime.now()
+            today = now.date()
             
             # Get clients that need reminders using optimized query
             from sqlalchemy import or_
@@ -6209,76 +6137,33 @@ async def manual_sync_queue(user_id: int):
                 result['next_send_time'] = 'Nenhum lembrete pendente hoje'
                 return result
             
-            # Process each client with timeout control
-            messages_queued = 0
+            prepared = []  # (client_id, phone, template_type, message_content)
+            # Same template priority (user_<canonical> first) and daily de-dup as the scheduler's engine,
+            # so pressing the button again or after the automatic run does not resend
+            templates = scheduler_service._get_active_templates_by_bucket(session, user.id)
+            sent_today = scheduler_service._sent_today_keys(session, user.id, today)
             
             for client in clients_needing_reminders:
                 try:
-                    # Determine reminder type
-                    days_until_due = (client.due_date - today).days
-                    
-                    if days_until_due == 2:
-                        reminder_type = 'reminder_2_days'
-                    elif days_until_due == 1:
-                        reminder_type = 'reminder_1_day'
-                    elif days_until_due == 0:
-                        reminder_type = 'reminder_due_date'
-                    elif days_until_due == -1:
-                        reminder_type = 'reminder_overdue'
-                    else:
-                        continue  # Skip if not in range
-                    
-                    # Get template for this reminder type
-                    template = session.query(MessageTemplate).filter_by(
-                        user_id=user.id,
-                        template_type=reminder_type,
-                        is_active=True
-                    ).first()
+                    # Determine reminder bucket (D-2, D-1, D0, overdue)
+                    bucket = scheduler_service._template_for_delta_key((client.due_date - today).days)
+                    template = templates.get(bucket)
                     
                     if not template:
-                        continue  # Skip if no template
-                    
-                    # Process template with client data
-                    message_content = template.content
-                    message_content = message_content.replace('{cliente}', client.name or 'Cliente')
-                    message_content = message_content.replace('{servico}', client.service_description or 'Serviço')
-                    message_content = message_content.replace('{valor}', f'R$ {client.monthly_value:.2f}' if client.monthly_value else 'R$ 0,00')
-                    message_content = message_content.replace('{vencimento}', client.due_date.strftime('%d/%m/%Y') if client.due_date else 'Não definido')
+                        continue  # Skip if out of range or no template
                     
-                    # Send message without timeout (synchronous call)
-                    result_send = whatsapp_service.send_message(client.phone_number, message_content, user.id)
+                    if (client.id, template.template_type) in sent_today:
+                        continue  # Already sent today
                     
-                    # Log the message
-                    status = 'sent' if result_send.get('success') else 'failed'
-                    error_msg = result_send.get('error') if not result_send.get('success') else None
+                    # Same variables ({nome}, {plano}, {valor}, ...) as every other send path
+                    message_content = replace_template_variables(template.content, client)
                     
-                    message_log = MessageLog(
-                        user_id=user.id,
-                        client_id=client.id,
-                        template_type=reminder_type,
-                        recipient_phone=client.phone_number,
-                        message_content=message_content,
-                        sent_at=datetime.now(),
-                        status=status,
-                        error_message=error_msg
-                    )
-                    session.add(message_log)
-                    
-                    if result_send.get('success'):
-                        messages_queued += 1
+                    prepared.append((client.id, client.phone_number, template.template_type, message_content))
                         
-                except asyncio.TimeoutError:
-                    logger.warning(f"Timeout sending message to client {client.id} during manual sync")
-                    continue
                 except Exception as e:
                     logger.error(f"Error processing client {client.id} in manual sync: {e}")
                     continue
             
-            session.commit()
-            
-            result['success'] = True
-            result['messages_queued'] = messages_queued
-            
             # Get user's schedule settings for next send time
             from models import UserScheduleSettings
             schedule_settings = session.query(UserScheduleSettings).filter_by(
@@ -6289,6 +6174,53 @@ async def manual_sync_queue(user_id: int):
                 result['next_send_time'] = f"Próximo: {schedule_settings.morning_reminder_time} (amanhã)"
             else:
                 result['next_send_time'] = "Próximo: 09:00 (amanhã)"
+        
+        # 2) Send concurrently on worker threads (send_message is blocking HTTP),
+        # bounded like the scheduler's sends, without stalling the bot's event loop
+        semaphore = asyncio.Semaphore(WHATSAPP_SEND_WORKERS)
+        
+        async def send_one(phone, message_content):
+            async with semaphore:
+                return await asyncio.to_thread(whatsapp_service.send_message, phone, message_content, user_id)
+        
+        results = await asyncio.gather(
+            *(send_one(phone, message_content) for _, phone, _, message_content in prepared),
+            return_exceptions=True
+        )
+        
+        messages_queued = 0
+        log_rows = []
+        for (client_id, phone, template_type, message_content), result_send in zip(prepared, results):
+            if isinstance(result_send, Exception):
+                logger.error(f"Error sending to client {client_id} in manual sync: {result_send}")
+                result_send = {'success': False, 'error': str(result_send)}
+            
+            # Log the message
+            status = 'sent' if result_send.get('success') else 'failed'
+            error_msg = result_send.get('error') if not result_send.get('success') else None
+            
+            log_rows.append({
+                'user_id': user_id,
+                'client_id': client_id,
+                'template_type': template_type,
+                'recipient_phone': phone,
+                'message_content': message_content,
+                'sent_at': now,
+                'status': status,
+                'error_message': error_msg
+            })
+            
+            if result_send.get('success'):
+                messages_queued += 1
+        
+        # 3) Write all logs in a new short session with one multi-row INSERT
+        if log_rows:
+            with db_service.get_session() as session:
+                session.execute(insert(MessageLog), log_rows)
+                session.commit()
+        
+        result['success'] = True
+        result['messages_queued'] = messages_queued
                 
         return result
         
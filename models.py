@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Float, Text, ForeignKey, Date
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Float, Text, ForeignKey, Date, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime, timedelta
@@ -57,6 +57,10 @@ class Client(Base):
     user = relationship("User", back_populates="clients")
     message_logs = relationship("MessageLog", back_populates="client", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index('ix_clients_user_id_status_due_date', 'user_id', 'status', 'due_date'),  # scheduler + dashboard
+    )
+
 class Subscription(Base):
     __tablename__ = 'subscriptions'
     
@@ -74,6 +78,10 @@ class Subscription(Base):
     
     # Relationships
     user = relationship("User", back_populates="subscriptions")
+    
+    __table_args__ = (
+        Index('ix_subscriptions_status_created_at', 'status', 'created_at'),  # scheduler: pending payments scan
+    )
 
 class MessageTemplate(Base):
     __tablename__ = 'message_templates'
@@ -109,6 +117,10 @@ class MessageLog(Base):
     user = relationship("User", back_populates="message_logs")
     client = relationship("Client", back_populates="message_logs")
 
+    __table_args__ = (
+        Index('ix_message_logs_user_id_sent_at', 'user_id', 'sent_at'),  # scheduler: already-sent-today lookup
+    )
+
 class SystemSettings(Base):
     __tablename__ = 'system_settings'
     
@@ -135,6 +147,10 @@ class UserScheduleSettings(Base):
     # Relationships
     user = relationship("User", backref="schedule_settings")
 
+    __table_args__ = (
+        Index('ix_user_schedule_settings_morning_time', 'morning_reminder_time'),  # scheduler: per-minute due check
+    )
+
 class WhatsAppSession(Base):
     __tablename__ = 'whatsapp_sessions'
     
@@ -61,6 +61,10 @@ class DatabaseService:
         - Garante clients.reminder_status e clients.last_reminder_sent
         - Garante message_templates.is_default
         - Cria UNIQUE (user_id, template_type)
+        - Garante índice subscriptions(status, created_at)
+        - Garante índice user_schedule_settings(morning_reminder_time)
+        - Garante índice message_logs(user_id, sent_at)
+        - Garante índice clients(user_id, status, due_date)
         - Converte templates de usuário canônicos para 'user_<canônico>'
           sem tocar nos padrões (is_default = TRUE)
         - Desativa duplicatas quando já existir a versão 'user_<...>' do mesmo usuário
@@ -130,6 +134,34 @@ class DatabaseService:
                     except Exception as e:
                         logger.warning(f"Could not create unique constraint yet: {e}")
 
+                # subscriptions(status, created_at) — varredura de pagamentos pendentes
+                connection.execute(text("""
+                    CREATE INDEX IF NOT EXISTS ix_subscriptions_status_created_at
+                    ON subscriptions (status, created_at)
+                """))
+                connection.commit()
+
+                # user_schedule_settings(morning_reminder_time) — checagem por minuto do agendador
+                connection.execute(text("""
+                    CREATE INDEX IF NOT EXISTS ix_user_schedule_settings_morning_time
+                    ON user_schedule_settings (morning_reminder_time)
+                """))
+                connection.commit()
+
+                # message_logs(user_id, sent_at) — "já enviado hoje" por usuário
+                connection.execute(text("""
+                    CREATE INDEX IF NOT EXISTS ix_message_logs_user_id_sent_at
+                    ON message_logs (user_id, sent_at)
+                """))
+                connection.commit()
+
+                # clients(user_id, status, due_date) — buckets de vencimento por usuário
+                connection.execute(text("""
+                    CREATE INDEX IF NOT EXISTS ix_clients_user_id_status_due_date
+                    ON clients (user_id, status, due_date)
+                """))
+                connection.commit()
+
                 # ---------- Normalização: prefixa user_ quando necessário ----------
                 # buckets principais usados pelo agendador + RENEWAL
                 canonical_with_renewal = ('reminder_2_days','reminder_1_day','reminder_due_date','reminder_overdue','renewal')
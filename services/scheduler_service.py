@@ -1,24 +1,93 @@
-import schedule
-import time
-import threading
 import logging
-from datetime import datetime, timedelta, date as _date
+import threading
+from datetime import datetime, timedelta
 import asyncio
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import pytz
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor as JobThreadPoolExecutor
+from sqlalchemy import case, func, insert, literal, or_, tuple_
+from sqlalchemy.orm import joinedload, load_only
+
+from models import Client, MessageLog, MessageTemplate, Subscription, User, UserScheduleSettings
+# singletons (não crie DatabaseService() neste módulo)
+from services.database_service import db_service
+from services.whatsapp_service import whatsapp_service
 
 logger = logging.getLogger(__name__)
 
 SAO_PAULO_TZ = pytz.timezone("America/Sao_Paulo")
 
-# NOVO: traga o singleton (não crie DatabaseService() neste módulo)
-from services.database_service import db_service
+# Jobs do agendador rodando ao mesmo tempo (cada job continua com no máximo uma instância)
+SCHEDULER_JOB_WORKERS = int(os.getenv("SCHEDULER_JOB_WORKERS", "4"))
+
+# Espera máxima, no stop(), pelas notificações do Telegram ainda na fila
+NOTIFICATION_DRAIN_TIMEOUT = 10
+
+# Envios de WhatsApp em paralelo no total: um pool só, dividido entre os usuários do tick
+# (limita também a taxa contra o Baileys)
+WHATSAPP_SEND_WORKERS = int(os.getenv("WHATSAPP_SEND_WORKERS", "8"))
+
+# Usuários com lembretes processados ao mesmo tempo; deixa folga no pool do banco (DB_POOL_SIZE)
+REMINDER_USER_WORKERS = int(os.getenv("REMINDER_USER_WORKERS", "3"))
+
+# Clientes lidos por lote no motor diário (yield_per)
+CLIENTS_FETCH_BATCH = 500
+
+# Consultas ao Mercado Pago em paralelo; pool próprio, fora da fila dos envios de WhatsApp
+PAYMENT_CHECK_WORKERS = int(os.getenv("PAYMENT_CHECK_WORKERS", "4"))
+
+# Assinaturas pendentes verificadas por lote (transação) em _check_pending_payments
+PENDING_PAYMENTS_BATCH = 100
+
+# bucket -> rótulo usado nas métricas do motor diário
+BUCKET_METRIC_LABELS = {
+    "D_MINUS_2": "D-2",
+    "D_MINUS_1": "D-1",
+    "D_ZERO":    "D0",
+    "OVERDUE":   "OVERDUE",
+}
+
+# Notificação de pagamento aprovado (montada uma vez; só os valores mudam por assinatura)
+APPROVAL_NOTIFICATION_TEMPLATE = (
+    "✅ **PAGAMENTO APROVADO AUTOMATICAMENTE!**\n\n"
+    "💰 **Valor:** R$ {amount:.2f}\n"
+    "📅 **Aprovado em:** {approved_at}\n\n"
+    "🎉 **Sua conta foi ativada!**\n"
+    "• Plano Premium ativo por 30 dias\n"
+    "• Todos os recursos liberados\n"
+    "• Próximo vencimento: {expires_at}\n\n"
+    "🚀 Use o comando /start para acessar todas as funcionalidades!"
+)
+
+TEMPLATE_VARIABLES = ('{nome}', '{plano}', '{valor}', '{vencimento}', '{servidor}', '{informacoes_extras}')
+_TEMPLATE_VAR_SPLIT_RE = re.compile("(" + "|".join(re.escape(v) for v in TEMPLATE_VARIABLES) + ")")
+
+
+@lru_cache(maxsize=512)
+def _compile_template(content):
+    """
+    Quebra o conteúdo do template uma única vez em tokens alternados:
+    índices pares são literais, ímpares são variáveis (ex.: '{nome}').
+    """
+    return tuple(_TEMPLATE_VAR_SPLIT_RE.split(content))
+
 
 class SchedulerService:
     def __init__(self):
         self.is_running = False
-        self.thread = None
-        self.loop = None
-        self._last_reset_date_sp = None
+        self.scheduler = None
+        self.loop = None          # loop asyncio compartilhado (thread própria) para envios no Telegram
+        self._loop_thread = None
+        self._notification_queue = None  # (telegram_id, msg) consumidos por _notification_worker no loop
+        self._notification_task = None   # task do _notification_worker (cancelada no stop)
+        self._io_pool = None  # criado sob demanda; reaproveitado entre execuções
+        self._user_pool = None  # usuários processados em paralelo no tick dos lembretes
+        self._payment_pool = None  # consultas de status no Mercado Pago
+        self._pool_lock = threading.Lock()  # criação sob demanda dos pools acima
 
         # ---- mapeamento canônico por bucket ----
         # Usaremos estes nomes base para priorizar user_<canônico> e, se não existir, o canônico.
@@ -63,42 +132,126 @@ class SchedulerService:
             return
 
         self.is_running = True
-        schedule.every().minute.do(self._check_reminder_times)
-        schedule.every().hour.do(self._check_due_dates)    # só informativo
-        schedule.every(2).minutes.do(self._check_pending_payments)
-        schedule.every(1).seconds.do(self._tick)
 
-        self.thread = threading.Thread(target=self._run_scheduler, daemon=True)
-        self.thread.start()
+        # um único loop asyncio para todos os jobs, em vez de um loop novo por chamada
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self.loop.run_forever, name="scheduler-loop", daemon=True
+        )
+        self._loop_thread.start()
+        # fila e worker criados dentro do loop que os consome
+        self._run_on_loop(self._start_notification_worker())
+
+        # coalesce: execuções perdidas rodam uma vez só; max_instances: nunca sobrepõe o mesmo job.
+        # Pool próprio e limitado: um _check_pending_payments lento não atrasa o tick dos lembretes.
+        self.scheduler = BackgroundScheduler(
+            timezone=SAO_PAULO_TZ,
+            executors={"default": JobThreadPoolExecutor(max_workers=SCHEDULER_JOB_WORKERS)},
+            job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 30},
+        )
+        self.scheduler.add_job(self._check_reminder_times, "cron", minute="*", id="reminder_times")
+        self.scheduler.add_job(self._check_due_dates, "interval", hours=1, id="due_dates")  # só informativo
+        self.scheduler.add_job(self._check_pending_payments, "interval", minutes=2, id="pending_payments")
+        # virada de dia (SP); roda também na partida, como o antigo tick
+        self.scheduler.add_job(
+            self._execute_daily_reset, "cron", hour=0, minute=0, id="daily_reset",
+            next_run_time=datetime.now(SAO_PAULO_TZ)
+        )
+        self.scheduler.start()
         logger.info("Scheduler service started")
 
     def stop(self):
         self.is_running = False
-        schedule.clear()
-        if self.thread:
-            self.thread.join()
+        if self.scheduler:
+            self.scheduler.shutdown(wait=True)
+            self.scheduler = None
+        with self._pool_lock:
+            pools = (self._user_pool, self._io_pool, self._payment_pool)
+            self._user_pool = self._io_pool = self._payment_pool = None
+        # usuários primeiro: eles ainda podem estar esperando envios no pool de I/O
+        for pool in pools:
+            if pool:
+                pool.shutdown(wait=True)
+        if self.loop:
+            # dá às notificações já enfileiradas uma chance de sair antes de parar o loop
+            try:
+                self._run_on_loop(self._notification_queue.join(), timeout=NOTIFICATION_DRAIN_TIMEOUT)
+            except Exception:
+                logger.warning("Stopping scheduler with %d notification(s) still queued",
+                               self._notification_queue.qsize())
+            # cancela o worker e espera a task terminar antes de parar/fechar o loop
+            try:
+                self._run_on_loop(self._stop_notification_worker(), timeout=5)
+            except Exception:
+                logger.warning("Notification worker did not stop cleanly", exc_info=True)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._loop_thread.join(timeout=5)
+            if not self._loop_thread.is_alive():
+                self.loop.close()
+            self.loop = None
+            self._loop_thread = None
+            self._notification_queue = None
+            self._notification_task = None
         logger.info("Scheduler service stopped")
 
-    def _run_scheduler(self):
-        while self.is_running:
-            try:
-                schedule.run_pending()
-                time.sleep(1)
-            except Exception as e:
-                logger.error(f"Error in scheduler: {e}", exc_info=True)
+    def _run_on_loop(self, coro, timeout=None):
+        """Executa a corrotina no loop compartilhado e espera o resultado (chamado das threads dos jobs)."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout=timeout)
 
-    # -------------------- Tick / Virada de dia --------------------
+    async def _start_notification_worker(self):
+        self._notification_queue = asyncio.Queue()
+        self._notification_task = asyncio.create_task(self._notification_worker())
 
-    def _tick(self):
+    async def _stop_notification_worker(self):
+        self._notification_task.cancel()
         try:
-            now_sp = datetime.now(SAO_PAULO_TZ)
-            today_sp = now_sp.date()
-            if self._last_reset_date_sp != today_sp:
-                logger.info(f"🌙 DIA TROCOU (SP): {today_sp}")
-                self._execute_daily_reset()
-                self._last_reset_date_sp = today_sp
-        except Exception as e:
-            logger.error(f"Error in _tick: {e}", exc_info=True)
+            await self._notification_task
+        except asyncio.CancelledError:
+            pass
+
+    def _queue_notification(self, telegram_id, msg):
+        """Enfileira uma notificação do Telegram e retorna na hora (thread-safe)."""
+        self.loop.call_soon_threadsafe(self._notification_queue.put_nowait, (telegram_id, msg))
+
+    async def _notification_worker(self):
+        from services.telegram_service import telegram_service
+        while True:
+            telegram_id, msg = await self._notification_queue.get()
+            try:
+                await telegram_service.send_notification(telegram_id, msg)
+            except Exception:
+                logger.exception("Error sending queued notification to %s", telegram_id)
+            finally:
+                self._notification_queue.task_done()
+
+    def _get_user_pool(self):
+        # separado do pool de I/O: cada usuário espera pelos próprios envios no _io_pool
+        with self._pool_lock:
+            if self._user_pool is None:
+                self._user_pool = ThreadPoolExecutor(
+                    max_workers=REMINDER_USER_WORKERS, thread_name_prefix="reminder-user"
+                )
+            return self._user_pool
+
+    def _get_io_pool(self):
+        # lock: as threads de usuário e o job de pagamentos chegam juntos no primeiro tick
+        with self._pool_lock:
+            if self._io_pool is None:
+                self._io_pool = ThreadPoolExecutor(
+                    max_workers=WHATSAPP_SEND_WORKERS, thread_name_prefix="reminder"
+                )
+            return self._io_pool
+
+    def _get_payment_pool(self):
+        # os locks do SKIP LOCKED e a conexão do banco não esperam atrás dos envios de WhatsApp
+        with self._pool_lock:
+            if self._payment_pool is None:
+                self._payment_pool = ThreadPoolExecutor(
+                    max_workers=PAYMENT_CHECK_WORKERS, thread_name_prefix="payment-check"
+                )
+            return self._payment_pool
+
+    # -------------------- Virada de dia --------------------
 
     def _execute_daily_reset(self):
         try:
@@ -106,14 +259,13 @@ class SchedulerService:
             current_time_str = now_sp.strftime("%H:%M")
             logger.info(f"🔄 MIDNIGHT RESET @ {current_time_str} (SP)")
 
-            from models import Client
 
             with db_service.get_session() as session:
                 yesterday_sp = (now_sp - timedelta(days=1)).date()
                 # compat: mantém campo legado, mas não interfere na lógica por log
-                session.query(Client).filter_by(status='active').update({
-                    'last_reminder_sent': yesterday_sp
-                })
+                session.query(Client).filter(Client.status == 'active').update(
+                    {Client.last_reminder_sent: yesterday_sp}, synchronize_session=False
+                )
                 session.commit()
         except Exception as e:
             logger.error(f"❌ Error in daily reset: {e}", exc_info=True)
@@ -122,8 +274,6 @@ class SchedulerService:
 
     def _check_reminder_times(self):
         try:
-            from models import User, UserScheduleSettings
-
             now_sp = datetime.now(SAO_PAULO_TZ)
             current_time_hhmm = now_sp.strftime("%H:%M")
             current_date_sp = now_sp.date()
@@ -131,110 +281,89 @@ class SchedulerService:
             logger.info(f"⏰ Checking reminder times at {current_time_hhmm} (São Paulo) — date={current_date_sp}")
 
             with db_service.get_session() as session:
-                users_settings = session.query(User, UserScheduleSettings).join(
-                    UserScheduleSettings, User.id == UserScheduleSettings.user_id, isouter=True
-                ).filter(User.is_active == True).all()
-
-                logger.info(f"Found {len(users_settings)} users to check")
-
-                for user, settings in users_settings:
-                    if not settings:
-                        settings = UserScheduleSettings(
-                            user_id=user.id,
-                            morning_reminder_time="09:00",
-                            daily_report_time="08:00",
-                            auto_send_enabled=True
-                        )
-                        session.add(settings)
-                        session.commit()
-                        logger.info(f"Created default schedule settings for user {user.id}")
-
-                    if hasattr(settings, "auto_send_enabled") and not settings.auto_send_enabled:
-                        logger.info(f"Auto send disabled for user {user.id}, skipping")
-                        continue
-
-                    times_to_check = set()
-                    if getattr(settings, "morning_reminder_time", None):
-                        times_to_check.add(settings.morning_reminder_time.strip())
-                    if getattr(settings, "evening_reminder_time", None):
-                        t = settings.evening_reminder_time.strip()
-                        if t:
-                            times_to_check.add(t)
-                    if getattr(settings, "custom_times", None):
-                        raw = settings.custom_times
-                        if raw and isinstance(raw, str):
-                            for t in raw.split(","):
-                                t = t.strip()
-                                if t:
-                                    times_to_check.add(t)
-
-                    valid_times = []
-                    for t in times_to_check:
-                        try:
-                            _ = datetime.strptime(t, "%H:%M").time()
-                            valid_times.append(t)
-                        except Exception:
-                            logger.warning(f"User {user.id}: ignoring invalid time '{t}'")
-
-                    if not valid_times:
-                        logger.info(f"User {user.id}: no valid times configured, skipping")
-                        continue
-
-                    already_ran_today = (getattr(settings, "last_morning_run", None) == current_date_sp)
-
-                    if (not already_ran_today) and (current_time_hhmm in valid_times):
-                        logger.info(f"✅ EXECUTING reminders for user {user.id} at {current_time_hhmm} (SP)")
-                        try:
-                            self._process_daily_reminders_sync(user.id)
-                            settings.last_morning_run = current_date_sp
-                            session.commit()
-                            logger.info(f"✅ COMPLETED user {user.id} at {current_time_hhmm}; last_morning_run={current_date_sp}")
-                        except Exception as e:
-                            logger.error(f"❌ Error processing reminders for user {user.id}: {e}", exc_info=True)
-                    else:
-                        if already_ran_today:
-                            logger.debug(f"⏭️  SKIP user {user.id}: already ran on {current_date_sp}")
-                        else:
-                            logger.debug(f"⏱️  WAIT user {user.id}: {current_time_hhmm} not in {sorted(valid_times)}")
+                # usuários ativos sem configuração recebem o padrão num único INSERT ... SELECT
+                # (sem carregar ids nem criar objetos; created_at é callable e não entra no from_select)
+                created_at = datetime.utcnow()
+                missing_settings = session.query(
+                    User.id, literal("09:00"), literal("08:00"), literal(True),
+                    literal(created_at), literal(created_at)
+                ).outerjoin(
+                    UserScheduleSettings, User.id == UserScheduleSettings.user_id
+                ).filter(
+                    User.is_active == True,
+                    UserScheduleSettings.id.is_(None)
+                )
+                created = session.execute(
+                    insert(UserScheduleSettings).from_select(
+                        ["user_id", "morning_reminder_time", "daily_report_time", "auto_send_enabled",
+                         "created_at", "updated_at"],
+                        missing_settings
+                    )
+                ).rowcount
+                if created:
+                    session.commit()
+                    logger.info(f"Created default schedule settings for {created} user(s)")
+
+                # o banco filtra: horário já chegou, envio automático ligado e ainda não rodou hoje.
+                # <= (não ==): um tick pulado/coalescido não perde o dia; last_morning_run evita repetir.
+                # (horários são gravados já validados como HH:MM, então a comparação de texto vale)
+                due_user_ids = [uid for (uid,) in session.query(User.id).join(
+                    UserScheduleSettings, User.id == UserScheduleSettings.user_id
+                ).filter(
+                    User.is_active == True,
+                    UserScheduleSettings.auto_send_enabled == True,
+                    UserScheduleSettings.morning_reminder_time <= current_time_hhmm,
+                    or_(
+                        UserScheduleSettings.last_morning_run.is_(None),
+                        UserScheduleSettings.last_morning_run != current_date_sp
+                    )
+                ).distinct().all()]
+
+            logger.info(f"Found {len(due_user_ids)} users due at {current_time_hhmm}")
+
+            # usuários são independentes (instância WhatsApp e linhas próprias): processa em paralelo,
+            # cada um com suas sessões curtas; o pool limita o uso do pool de conexões do banco
+            if due_user_ids:
+                completed = [user_id for user_id in self._get_user_pool().map(
+                    lambda user_id: self._run_user_reminders(user_id, current_date_sp, current_time_hhmm),
+                    due_user_ids
+                ) if user_id is not None]
+
+                # um único UPDATE/commit para o tick; se cair antes disso, o de-dup diário evita reenvio
+                if completed:
+                    with db_service.get_session() as session:
+                        session.query(UserScheduleSettings).filter(
+                            UserScheduleSettings.user_id.in_(completed)
+                        ).update({UserScheduleSettings.last_morning_run: current_date_sp}, synchronize_session=False)
+                    logger.info(f"last_morning_run={current_date_sp} for {len(completed)} user(s)")
         except Exception as e:
             logger.error(f"❌ Error checking reminder times: {e}", exc_info=True)
 
-    def _get_event_loop(self):
+    def _run_user_reminders(self, user_id, current_date_sp, current_time_hhmm):
+        """Roda o motor diário de um usuário; devolve o user_id se concluiu, senão None."""
+        logger.info("✅ EXECUTING reminders for user %s at %s (SP)", user_id, current_time_hhmm)
         try:
-            loop = asyncio.get_running_loop()
-            return loop
-        except RuntimeError:
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_closed():
-                    raise RuntimeError("Loop is closed")
-                return loop
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                return loop
+            self._process_daily_reminders_sync(user_id, current_date_sp)
+            logger.info("✅ COMPLETED user %s at %s", user_id, current_time_hhmm)
+            return user_id
+        except Exception as e:
+            logger.error(f"❌ Error processing reminders for user {user_id}: {e}", exc_info=True)
+            return None
 
     # -------------------- Due-dates (informativo, não bloqueia) --------------------
 
     def _check_due_dates(self):
         logger.info("Running due date info pass")
         try:
-            from models import Client
-
+            today_sp = datetime.now(SAO_PAULO_TZ).date()
+            # Client não tem coluna is_overdue: o antigo .all() + setattr não gravava nada.
+            # Contagem agregada no banco, sem materializar um objeto por cliente.
             with db_service.get_session() as session:
-                today_sp = datetime.now(SAO_PAULO_TZ).date()
-                try:
-                    overdue = session.query(Client).filter(Client.due_date < today_sp).all()
-                    ok = session.query(Client).filter(Client.due_date >= today_sp).all()
-                    for c in overdue:
-                        if hasattr(c, "is_overdue"):
-                            c.is_overdue = True
-                    for c in ok:
-                        if hasattr(c, "is_overdue"):
-                            c.is_overdue = False
-                    session.commit()
-                except Exception:
-                    pass
+                overdue, ok = session.query(
+                    func.count(case((Client.due_date < today_sp, 1))),
+                    func.count(case((Client.due_date >= today_sp, 1)))
+                ).one()
+            logger.info(f"Due date pass ({today_sp}): {overdue} vencido(s), {ok} em dia")
         except Exception as e:
             logger.error(f"Error checking due dates: {e}", exc_info=True)
 
@@ -244,83 +373,113 @@ class SchedulerService:
         logger.info("🔍 Checking pending payments for automatic processing")
         try:
             from services.payment_service import payment_service
-            from services.telegram_service import telegram_service
-            from models import User, Subscription
 
-            with db_service.get_session() as session:
-                yesterday_utc = datetime.utcnow() - timedelta(hours=24)
-                pending_subscriptions = session.query(Subscription).filter(
-                    Subscription.status == 'pending',
-                    Subscription.created_at >= yesterday_utc
-                ).all()
-
-                approved_count = 0
-                pending_count = 0
-
-                for subscription in pending_subscriptions:
-                    payment_status = payment_service.check_payment_status(subscription.payment_id)
-                    if payment_status['success']:
-                        current_status = payment_status['status']
-                        status_detail = payment_status.get('status_detail', 'N/A')
-
-                        if current_status == 'approved':
-                            approved_count += 1
-                            old_status = subscription.status
-                            subscription.status = 'approved'
-                            subscription.paid_at = datetime.utcnow()
-                            subscription.expires_at = datetime.utcnow() + timedelta(days=30)
-
-                            user = session.query(User).get(subscription.user_id)
-                            if user:
-                                user.is_trial = False
-                                user.is_active = True
-                                user.last_payment_date = datetime.utcnow()
-                                user.next_due_date = subscription.expires_at
-                                try:
-                                    msg = (
-                                        "✅ **PAGAMENTO APROVADO AUTOMATICAMENTE!**\n\n"
-                                        f"💰 **Valor:** R$ {subscription.amount:.2f}\n"
-                                        f"📅 **Aprovado em:** {datetime.now().strftime('%d/%m/%Y às %H:%M')}\n\n"
-                                        "🎉 **Sua conta foi ativada!**\n"
-                                        "• Plano Premium ativo por 30 dias\n"
-                                        "• Todos os recursos liberados\n"
-                                        f"• Próximo vencimento: {subscription.expires_at.strftime('%d/%m/%Y')}\n\n"
-                                        "🚀 Use o comando /start para acessar todas as funcionalidades!"
-                                    )
-                                    future = asyncio.run_coroutine_threadsafe(
-                                        telegram_service.send_message(user.telegram_id, msg),
-                                        self._get_event_loop()
-                                    )
-                                    future.result(timeout=10)
-                                except Exception:
-                                    logger.exception("Error sending approval notification")
-
-                            session.commit()
-                            logger.info(f"Payment {subscription.payment_id} updated: {old_status} → approved")
-
-                        elif current_status == 'pending':
-                            pending_count += 1
-                        elif current_status in ['rejected', 'cancelled']:
-                            subscription.status = current_status
-                            session.commit()
-                    else:
-                        logger.warning(f"Failed to check payment {subscription.payment_id}: {payment_status.get('error')}")
-
-                if len(pending_subscriptions) > 0:
-                    logger.info(
-                        f"Payments summary: {approved_count} approved, {pending_count} still pending, "
-                        f"{len(pending_subscriptions) - approved_count - pending_count} other status"
+            yesterday_utc = datetime.utcnow() - timedelta(hours=24)
+            # mesmo instante para todas as aprovações deste tick
+            now_utc = datetime.utcnow()
+            expires_at = now_utc + timedelta(days=30)
+            approved_at_label = datetime.now().strftime('%d/%m/%Y às %H:%M')
+            expires_at_label = expires_at.strftime('%d/%m/%Y')
+
+            approved_count = 0
+            pending_count = 0
+            checked_count = 0
+            cursor = None  # (created_at, id) da última linha do lote anterior
+
+            # lotes do mais novo para o mais antigo até esgotar a janela de 24h;
+            # o cursor avança sempre, então as que continuam pendentes não voltam no próximo lote
+            while True:
+                notifications = []  # (telegram_id, msg), enfileiradas após o commit do lote
+                with db_service.get_session() as session:
+                    # usuário vem no mesmo SELECT (evita um get() por aprovação);
+                    # SKIP LOCKED: outra instância do agendador não processa as mesmas linhas
+                    query = session.query(Subscription).options(
+                        joinedload(Subscription.user, innerjoin=True)
+                    ).filter(
+                        Subscription.status == 'pending',
+                        Subscription.created_at >= yesterday_utc
                     )
+                    if cursor is not None:
+                        query = query.filter(tuple_(Subscription.created_at, Subscription.id) < cursor)
+                    pending_subscriptions = query.order_by(
+                        Subscription.created_at.desc(), Subscription.id.desc()
+                    ).limit(
+                        PENDING_PAYMENTS_BATCH
+                    ).with_for_update(skip_locked=True, of=Subscription).all()
+
+                    if not pending_subscriptions:
+                        break
+                    last = pending_subscriptions[-1]
+                    cursor = (last.created_at, last.id)
+                    checked_count += len(pending_subscriptions)
+
+                    # consultas ao Mercado Pago em paralelo (só HTTP), no pool próprio dos pagamentos
+                    payment_statuses = list(self._get_payment_pool().map(
+                        payment_service.check_payment_status,
+                        [subscription.payment_id for subscription in pending_subscriptions]
+                    ))
+
+                    for subscription, payment_status in zip(pending_subscriptions, payment_statuses):
+                        if payment_status['success']:
+                            current_status = payment_status['status']
+                            status_detail = payment_status.get('status_detail', 'N/A')
+
+                            if current_status == 'approved':
+                                approved_count += 1
+                                old_status = subscription.status
+                                subscription.status = 'approved'
+                                subscription.paid_at = now_utc
+                                subscription.expires_at = expires_at
+
+                                user = subscription.user
+                                if user:
+                                    user.is_trial = False
+                                    user.is_active = True
+                                    user.last_payment_date = now_utc
+                                    user.next_due_date = expires_at
+                                    notifications.append((user.telegram_id, APPROVAL_NOTIFICATION_TEMPLATE.format(
+                                        amount=subscription.amount,
+                                        approved_at=approved_at_label,
+                                        expires_at=expires_at_label
+                                    )))
+
+                                logger.info("Payment %s updated: %s → approved", subscription.payment_id, old_status)
+
+                            elif current_status == 'pending':
+                                pending_count += 1
+                            elif current_status in ['rejected', 'cancelled']:
+                                subscription.status = current_status
+                        else:
+                            logger.warning("Failed to check payment %s: %s", subscription.payment_id, payment_status.get('error'))
+
+                    # uma transação por lote; libera os locks do SKIP LOCKED de uma vez
+                    session.commit()
+
+                # só avisa depois do commit; não espera o Telegram (o worker do loop entrega)
+                for telegram_id, msg in notifications:
+                    try:
+                        self._queue_notification(telegram_id, msg)
+                    except Exception:
+                        logger.exception("Error sending approval notification")
+
+                if len(pending_subscriptions) < PENDING_PAYMENTS_BATCH:
+                    break
+
+            if checked_count > 0:
+                logger.info(
+                    f"Payments summary: {approved_count} approved, {pending_count} still pending, "
+                    f"{checked_count - approved_count - pending_count} other status"
+                )
 
-                old_pending = session.query(Subscription).filter(
+            # pendentes com mais de 24h: um UPDATE direto, sem carregar as linhas
+            with db_service.get_session() as session:
+                expired_count = session.query(Subscription).filter(
                     Subscription.status == 'pending',
                     Subscription.created_at < yesterday_utc
-                ).all()
-                for old_sub in old_pending:
-                    old_sub.status = 'expired'
-                if old_pending:
-                    session.commit()
-                    logger.info(f"Expired {len(old_pending)} old pending payments")
+                ).update({Subscription.status: 'expired'}, synchronize_session=False)
+                session.commit()
+            if expired_count:
+                logger.info(f"Expired {expired_count} old pending payments")
         except Exception as e:
             logger.error(f"❌ Error checking pending payments: {e}", exc_info=True)
 
@@ -329,18 +488,12 @@ class SchedulerService:
     def _send_user_notifications(self):
         logger.info("Running daily user notifications")
         try:
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
-            self.loop.run_until_complete(self._process_user_notifications())
+            self._run_on_loop(self._process_user_notifications())
         except Exception as e:
             logger.error(f"Error sending user notifications: {e}", exc_info=True)
-        finally:
-            if self.loop:
-                self.loop.close()
 
     async def _process_user_notifications(self):
         from services.telegram_service import telegram_service
-        from models import Client, User
 
         today = datetime.now(SAO_PAULO_TZ).date()
         tomorrow = today + timedelta(days=1)
@@ -365,7 +518,7 @@ class SchedulerService:
 
                     if overdue_clients or due_today or due_tomorrow or due_day_after:
                         notification_text = self._build_notification_message(
-                            overdue_clients, due_today, due_tomorrow, due_day_after
+                            overdue_clients, due_today, due_tomorrow, due_day_after, today
                         )
                         success = await telegram_service.send_notification(
                             user.telegram_id, notification_text
@@ -377,39 +530,41 @@ class SchedulerService:
         except Exception as e:
             logger.error(f"Error processing user notifications: {e}", exc_info=True)
 
-    def _build_notification_message(self, overdue_clients, due_today, due_tomorrow, due_day_after):
-        message = "📅 **Relatório Diário de Vencimentos**\n\n"
+    def _build_notification_message(self, overdue_clients, due_today, due_tomorrow, due_day_after, today=None):
+        if today is None:
+            today = datetime.now(SAO_PAULO_TZ).date()
+        parts = ["📅 **Relatório Diário de Vencimentos**\n\n"]
         if overdue_clients:
-            message += f"🔴 **{len(overdue_clients)} cliente(s) em atraso:**\n"
+            parts.append(f"🔴 **{len(overdue_clients)} cliente(s) em atraso:**\n")
             for client in overdue_clients[:5]:
-                days_overdue = (datetime.now(SAO_PAULO_TZ).date() - client.due_date).days
-                message += f"• {client.name} - {days_overdue} dia(s) de atraso\n"
+                days_overdue = (today - client.due_date).days
+                parts.append(f"• {client.name} - {days_overdue} dia(s) de atraso\n")
             if len(overdue_clients) > 5:
-                message += f"• ... e mais {len(overdue_clients) - 5} cliente(s)\n"
-            message += "\n"
+                parts.append(f"• ... e mais {len(overdue_clients) - 5} cliente(s)\n")
+            parts.append("\n")
         if due_today:
-            message += f"🟡 **{len(due_today)} cliente(s) vencem hoje:**\n"
+            parts.append(f"🟡 **{len(due_today)} cliente(s) vencem hoje:**\n")
             for client in due_today[:5]:
-                message += f"• {client.name} - R$ {client.plan_price:.2f}\n"
+                parts.append(f"• {client.name} - R$ {client.plan_price:.2f}\n")
             if len(due_today) > 5:
-                message += f"• ... e mais {len(due_today) - 5} cliente(s)\n"
-            message += "\n"
+                parts.append(f"• ... e mais {len(due_today) - 5} cliente(s)\n")
+            parts.append("\n")
         if due_tomorrow:
-            message += f"🟠 **{len(due_tomorrow)} cliente(s) vencem amanhã:**\n"
+            parts.append(f"🟠 **{len(due_tomorrow)} cliente(s) vencem amanhã:**\n")
             for client in due_tomorrow[:5]:
-                message += f"• {client.name} - R$ {client.plan_price:.2f}\n"
+                parts.append(f"• {client.name} - R$ {client.plan_price:.2f}\n")
             if len(due_tomorrow) > 5:
-                message += f"• ... e mais {len(due_tomorrow) - 5} cliente(s)\n"
-            message += "\n"
+                parts.append(f"• ... e mais {len(due_tomorrow) - 5} cliente(s)\n")
+            parts.append("\n")
         if due_day_after:
-            message += f"🔵 **{len(due_day_after)} cliente(s) vencem em 2 dias:**\n"
+            parts.append(f"🔵 **{len(due_day_after)} cliente(s) vencem em 2 dias:**\n")
             for client in due_day_after[:5]:
-                message += f"• {client.name} - R$ {client.plan_price:.2f}\n"
+                parts.append(f"• {client.name} - R$ {client.plan_price:.2f}\n")
             if len(due_day_after) > 5:
-                message += f"• ... e mais {len(due_day_after) - 5} cliente(s)\n"
-            message += "\n"
-        message += "📱 Use o menu **👥 Clientes** para gerenciar seus clientes."
-        return message
+                parts.append(f"• ... e mais {len(due_day_after) - 5} cliente(s)\n")
+            parts.append("\n")
+        parts.append("📱 Use o menu **👥 Clientes** para gerenciar seus clientes.")
+        return "".join(parts)
 
     # -------------------- Motor diário por delta (OFICIAL) --------------------
 
@@ -424,94 +579,96 @@ class SchedulerService:
             return "OVERDUE"
         return None
 
-    def _get_active_template_for_bucket(self, session, user_id: int, key: str):
+    def _get_active_templates_by_bucket(self, session, user_id: int) -> dict:
         """
-        Prioridade:
+        Carrega numa única consulta os templates ativos do usuário e resolve, por bucket:
           1) user_<canônico> ativo do usuário
           2) canônico default ativo DO MESMO USUÁRIO (is_default=True)
-          3) aliases (legado) ativos do usuário
+          3) aliases (legado) ativos do usuário, o de menor id
+        Buckets sem template ficam fora do dict.
         """
-        from models import MessageTemplate
-
-        canonical = self.BUCKET_TO_CANON.get(key)
-        if not canonical:
-            return None
-
-        # 1) user_<canônico> do usuário
-        t_user = session.query(MessageTemplate).filter(
-            MessageTemplate.user_id == user_id,
-            MessageTemplate.is_active == True,
-            MessageTemplate.template_type == f"user_{canonical}"
-        ).first()
-        if t_user:
-            return t_user
-
-        # 2) canônico default ativo DO MESMO USUÁRIO
-        t_sys = session.query(MessageTemplate).filter(
+        candidate_types = set()
+        for key, canonical in self.BUCKET_TO_CANON.items():
+            candidate_types.add(f"user_{canonical}")
+            candidate_types.add(canonical)
+            candidate_types.update(self.TEMPLATE_ALIASES.get(key, []))
+
+        by_type = {}  # template_type -> template de menor id
+        for t in session.query(MessageTemplate).filter(
             MessageTemplate.user_id == user_id,
             MessageTemplate.is_active == True,
-            MessageTemplate.template_type == canonical,
-            MessageTemplate.is_default == True
-        ).first()
-        if t_sys:
-            return t_sys
-
-        # 3) aliases legados do usuário (caso exista base antiga)
-        alias_list = self.TEMPLATE_ALIASES.get(key, [])
-        if alias_list:
-            t_legacy = session.query(MessageTemplate).filter(
-                MessageTemplate.user_id == user_id,
-                MessageTemplate.is_active == True,
-                MessageTemplate.template_type.in_(alias_list)
-            ).order_by(MessageTemplate.id.asc()).first()
-            if t_legacy:
-                return t_legacy
-
-        return None
-
-    def _already_sent_today(self, session, user_id, client_id, template_type) -> bool:
-        from models import MessageLog
-        from sqlalchemy import func
-        today_sp = datetime.now(SAO_PAULO_TZ).date()
-        return session.query(MessageLog).filter(
+            MessageTemplate.template_type.in_(candidate_types)
+        ).order_by(MessageTemplate.id.asc()):
+            by_type.setdefault(t.template_type, t)
+
+        resolved = {}
+        for key, canonical in self.BUCKET_TO_CANON.items():
+            template = by_type.get(f"user_{canonical}")
+            if template is None:
+                t_sys = by_type.get(canonical)
+                if t_sys is not None and t_sys.is_default:
+                    template = t_sys
+            if template is None:
+                legacy = [by_type[a] for a in self.TEMPLATE_ALIASES.get(key, []) if a in by_type]
+                if legacy:
+                    template = min(legacy, key=lambda t: t.id)
+            if template is not None:
+                resolved[key] = template
+        return resolved
+
+    def _sent_today_keys(self, session, user_id, today_sp) -> set:
+        """(client_id, template_type) já registrados hoje para o usuário, numa única consulta."""
+        # intervalo semiaberto [hoje, amanhã) em vez de date(sent_at): a coluna fica indexável
+        day_start = datetime.combine(today_sp, datetime.min.time())
+        rows = session.query(MessageLog.client_id, MessageLog.template_type).filter(
             MessageLog.user_id == user_id,
-            MessageLog.client_id == client_id,
-            MessageLog.template_type == template_type,
-            func.date(MessageLog.sent_at) == today_sp
-        ).first() is not None
+            MessageLog.sent_at >= day_start,
+            MessageLog.sent_at < day_start + timedelta(days=1)
+        ).distinct().all()
+        return {(client_id, template_type) for client_id, template_type in rows}
 
-    def _process_daily_reminders_sync(self, user_id):
+    def _process_daily_reminders_sync(self, user_id, today_sp=None):
         """
         Envia 1 template por cliente/dia, conforme o delta:
         D-2, D-1, D0 e D+N (overdue) diariamente até renovar (mudar due_date).
         Prioriza user_<bucket>, cai no canônico default do usuário se não houver
         e aceita aliases legados.
+        `today_sp` vem do tick do agendador (calculado uma vez); se omitido,
+        usa a data atual de São Paulo.
         """
-        logger.info(f"🚀 SYNC DAILY ENGINE: user {user_id}")
+        logger.info("🚀 SYNC DAILY ENGINE: user %s", user_id)
         try:
-            from services.whatsapp_service import WhatsAppService
-            from models import Client, MessageLog
+            ws = whatsapp_service
+            if today_sp is None:
+                today_sp = datetime.now(SAO_PAULO_TZ).date()
 
-            ws = WhatsAppService()
-            today_sp = datetime.now(SAO_PAULO_TZ).date()
+            # métricas por bucket
+            bucket_counts = dict.fromkeys(BUCKET_METRIC_LABELS.values(), 0)
+            sent_count = 0
+            no_template = 0
+            dedup = 0
 
+            # 1) leitura (sessão curta): (client_id, phone, template_type, msg) em tuplas simples
+            to_send = []
             with db_service.get_session() as session:
-                clients = session.query(Client).filter(
+                sent_today = self._sent_today_keys(session, user_id, today_sp)
+                templates = self._get_active_templates_by_bucket(session, user_id)
+
+                # um único range: só quem cai em algum bucket (D-2 até vencidos);
+                # load_only: só as colunas do render/envio (sem notes, timestamps etc.);
+                # yield_per: lido em lotes (cursor no servidor), sem materializar todos os clientes
+                clients = session.query(Client).options(load_only(
+                    Client.id, Client.name, Client.phone_number, Client.plan_name, Client.plan_price,
+                    Client.due_date, Client.server, Client.other_info
+                )).filter(
                     Client.user_id == user_id,
-                    Client.auto_reminders_enabled == True
-                ).all()
-
-                if not clients:
-                    logger.info(f"SYNC DAILY ENGINE: user {user_id} sem clientes elegíveis")
-                    return
-
-                # métricas por bucket
-                bucket_counts = {"D-2": 0, "D-1": 0, "D0": 0, "OVERDUE": 0}
-                sent_count = 0
-                no_template = 0
-                dedup = 0
+                    Client.auto_reminders_enabled == True,
+                    Client.due_date <= today_sp + timedelta(days=2)
+                ).yield_per(CLIENTS_FETCH_BATCH)
 
+                clients_seen = 0
                 for client in clients:
+                    clients_seen += 1
                     if not client.due_date:
                         continue
 
@@ -521,63 +678,117 @@ class SchedulerService:
                         continue
 
                     # métrica
-                    if key == "D_MINUS_2":
-                        bucket_counts["D-2"] += 1
-                    elif key == "D_MINUS_1":
-                        bucket_counts["D-1"] += 1
-                    elif key == "D_ZERO":
-                        bucket_counts["D0"] += 1
-                    elif key == "OVERDUE":
-                        bucket_counts["OVERDUE"] += 1
+                    bucket_counts[BUCKET_METRIC_LABELS[key]] += 1
 
                     # pega template ativo, priorizando user_<canônico>, depois canônico default do mesmo usuário
-                    template = self._get_active_template_for_bucket(session, user_id, key)
+                    template = templates.get(key)
                     if not template:
                         no_template += 1
                         continue
 
                     # de-dup por dia (por tipo efetivamente usado)
-                    if self._already_sent_today(session, user_id, client.id, template.template_type):
+                    if (client.id, template.template_type) in sent_today:
                         dedup += 1
                         continue
 
                     msg = self._replace_template_variables(template.content or "", client)
+                    to_send.append((client.id, client.phone_number, template.template_type, msg))
 
-                    try:
-                        result = ws.send_message(client.phone_number, msg, user_id)
-                        status = 'sent' if result.get('success') else 'failed'
-                        error_msg = result.get('error') if not result.get('success') else None
-                    except Exception as e:
-                        status = 'failed'
-                        error_msg = str(e)
-
-                    log = MessageLog(
-                        user_id=user_id,
-                        client_id=client.id,
-                        template_type=template.template_type,  # preserva tipo real (user_... ou canônico)
-                        recipient_phone=client.phone_number,
-                        message_content=msg,
-                        sent_at=datetime.now(),
-                        status=status,
-                        error_message=error_msg
+                if not clients_seen:
+                    logger.info("SYNC DAILY ENGINE: user %s sem clientes elegíveis", user_id)
+                    return
+
+            # nada a enviar: sem pool, sem transação de escrita
+            if to_send:
+                # 2) envios em paralelo, sem conexão de banco presa durante o HTTP;
+                #    um "não conectado" só corta o resto do lote se a checagem de status confirmar
+                disconnected = threading.Event()
+                recheck_lock = threading.Lock()
+                results = list(self._get_io_pool().map(
+                    lambda item: self._send_whatsapp(ws, user_id, item[1], item[3], disconnected, recheck_lock),
+                    to_send
+                ))
+                if disconnected.is_set():
+                    logger.warning(
+                        "⚠️ SYNC DAILY ENGINE: WhatsApp do user %s desconectado; %d envio(s) pulados sem log "
+                        "(voltam no próximo disparo do dia)", user_id, results.count(None)
                     )
-                    session.add(log)
+
+                # 3) escrita (nova sessão curta), depois que todos os envios terminaram
+                batch_ts = datetime.now()  # um único timestamp para o lote
+                log_rows = []
+                for (client_id, phone, template_type, msg), result in zip(to_send, results):
+                    if result is None:
+                        continue  # pulado após desconexão confirmada: sem log, não conta no de-dup
+                    status, error_msg = result
+                    log_rows.append({
+                        'user_id': user_id,
+                        'client_id': client_id,
+                        'template_type': template_type,  # preserva tipo real (user_... ou canônico)
+                        'recipient_phone': phone,
+                        'message_content': msg,
+                        'sent_at': batch_ts,
+                        'status': status,
+                        'error_message': error_msg,
+                    })
                     if status == 'sent':
                         sent_count += 1
 
-                session.commit()
-                logger.info(
-                    f"✅ SYNC DAILY ENGINE (user {user_id}) "
-                    f"buckets: D-2={bucket_counts['D-2']}, D-1={bucket_counts['D-1']}, "
-                    f"D0={bucket_counts['D0']}, OVERDUE={bucket_counts['OVERDUE']} | "
-                    f"enviados={sent_count}, sem_template={no_template}, ja_enviado_hoje={dedup}"
-                )
+                with db_service.get_session() as session:
+                    # executemany: no SQLAlchemy 2.x vira INSERT multi-VALUES (insertmanyvalues)
+                    session.execute(insert(MessageLog), log_rows)
+                    session.commit()
+
+            logger.info(
+                "✅ SYNC DAILY ENGINE (user %s) buckets: D-2=%d, D-1=%d, D0=%d, OVERDUE=%d | "
+                "enviados=%d, sem_template=%d, ja_enviado_hoje=%d",
+                user_id, bucket_counts['D-2'], bucket_counts['D-1'], bucket_counts['D0'],
+                bucket_counts['OVERDUE'], sent_count, no_template, dedup
+            )
 
         except Exception as e:
             logger.error(f"❌ SYNC DAILY ENGINE error (user {user_id}): {e}", exc_info=True)
 
     # -------------------- Util --------------------
 
+    def _send_whatsapp(self, ws, user_id, phone_number, msg, disconnected=None, recheck_lock=None):
+        """
+        Envia uma mensagem e devolve (status, error_msg) sem levantar exceção.
+        Com `disconnected` (threading.Event do lote), um envio que volta "não conectado"
+        reconsulta o status da instância; só com a desconexão confirmada o Event é marcado
+        e os envios ainda não iniciados devolvem None (não tentados, sem MessageLog).
+        """
+        if disconnected is not None and disconnected.is_set():
+            return None
+        try:
+            result = ws.send_message(phone_number, msg, user_id)
+            if result.get('success'):
+                return 'sent', None
+            error_msg = result.get('error')
+            if disconnected is not None and error_msg and (
+                'não conectado' in error_msg.lower() or 'not connected' in error_msg.lower()
+            ):
+                # uma reconsulta por vez; se outra thread já confirmou, não repete
+                with recheck_lock:
+                    if not disconnected.is_set() and self._instance_disconnected(ws, user_id):
+                        disconnected.set()
+            return 'failed', error_msg
+        except Exception as e:
+            return 'failed', str(e)
+
+    def _instance_disconnected(self, ws, user_id):
+        """True só quando a instância está comprovadamente desconectada."""
+        try:
+            status = ws.check_instance_status(user_id)
+        except Exception as e:
+            logger.warning("Status do WhatsApp indisponível para user %s: %s", user_id, e)
+            return False
+        # falha da própria checagem (servidor fora, timeout, health divergente) não conta como desconectado
+        state = status.get('state') or ''
+        if not status.get('success') or state in ('timeout', 'error', 'http_error') or state.endswith('_health_corrected'):
+            return False
+        return not status.get('connected')
+
     def _replace_template_variables(self, template_content, client):
         variables = {
             '{nome}': client.name,
@@ -587,10 +798,11 @@ class SchedulerService:
             '{servidor}': getattr(client, "server", None) or 'Não definido',
             '{informacoes_extras}': getattr(client, "other_info", None) or ''
         }
-        result = template_content or ""
-        for var, value in variables.items():
-            result = result.replace(var, str(value))
-        return result.strip()
+        tokens = _compile_template(template_content or "")
+        parts = list(tokens)
+        for i in range(1, len(parts), 2):
+            parts[i] = str(variables[parts[i]])
+        return "".join(parts).strip()
 
 # Global instance
 scheduler_service = SchedulerService()
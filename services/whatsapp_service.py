@@ -1,9 +1,14 @@
+import os
 import requests
 import logging
 from typing import Dict, Any
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
+# Conexões keep-alive mantidas com o Baileys (>= envios em paralelo do agendador)
+WHATSAPP_HTTP_POOL_SIZE = int(os.getenv("WHATSAPP_HTTP_POOL_SIZE", "16"))
+
 def normalize_brazilian_phone(phone_number: str) -> str:
     """
     Normalize Brazilian phone numbers for modern WhatsApp/Baileys.
@@ -61,8 +66,6 @@ def normalize_brazilian_phone(phone_number: str) -> str:
 class WhatsAppService:
     def __init__(self):
         # Support Railway environment with internal service communication
-        import os
-        
         # Check for Railway environment variables
         railway_environment = os.getenv('RAILWAY_ENVIRONMENT_NAME')
         whatsapp_url = os.getenv('WHATSAPP_SERVICE_URL')
@@ -80,6 +83,12 @@ class WhatsAppService:
         self.headers = {
             'Content-Type': 'application/json'
         }
+        
+        # One pooled HTTP session for the singleton: reuses TCP connections across sends
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=WHATSAPP_HTTP_POOL_SIZE, pool_maxsize=WHATSAPP_HTTP_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         logger.info(f"WhatsApp Service initialized with URL: {self.baileys_url}")
     
     def send_message(self, phone_number: str, message: str, user_id: int) -> Dict[str, Any]:
@@ -104,7 +113,7 @@ class WhatsAppService:
             
             logger.info(f"Sending WhatsApp message to {clean_phone}")
             
-            response = requests.post(
+            response = self.session.post(
                 url,
                 json=payload,
                 headers=self.headers,
@@ -173,7 +182,7 @@ class WhatsAppService:
         try:
             url = f"{self.baileys_url}/restore/{user_id}"
             
-            response = requests.post(
+            response = self.session.post(
                 url,
                 headers=self.headers,
                 timeout=30  # Railway optimized timeout
@@ -205,7 +214,7 @@ class WhatsAppService:
         try:
             url = f"{self.baileys_url}/health"
             
-            response = requests.get(
+            response = self.session.get(
                 url,
                 headers=self.headers,
                 timeout=20  # Railway optimized timeout
@@ -245,7 +254,7 @@ class WhatsAppService:
             
             try:
                 url = f"{self.baileys_url}/status/{user_id}"
-                response = requests.get(
+                response = self.session.get(
                     url,
                     headers=self.headers,
                     timeout=3  # Short timeout to avoid hanging
@@ -329,7 +338,7 @@ class WhatsAppService:
             
             logger.info(f"Requesting pairing code for user {user_id} with phone {phone_number}")
             
-            response = requests.post(
+            response = self.session.post(
                 url,
                 json=payload,
                 headers=self.headers,
@@ -381,7 +390,7 @@ class WhatsAppService:
         try:
             url = f"{self.baileys_url}/pairing-code/{user_id}"
             
-            response = requests.get(
+            response = self.session.get(
                 url,
                 headers=self.headers,
                 timeout=20  # Railway optimized timeout
@@ -413,7 +422,7 @@ class WhatsAppService:
             # Use status endpoint instead of non-existent /qr endpoint
             url = f"{self.baileys_url}/status/{user_id}"
             
-            response = requests.get(
+            response = self.session.get(
                 url,
                 headers=self.headers,
                 timeout=20  # Railway optimized timeout
@@ -457,7 +466,7 @@ class WhatsAppService:
         try:
             url = f"{self.baileys_url}/disconnect/{user_id}"
             
-            response = requests.post(
+            response = self.session.post(
                 url,
                 headers=self.headers,
                 timeout=20  # Railway optimized timeout
@@ -488,7 +497,7 @@ class WhatsAppService:
         try:
             url = f"{self.baileys_url}/reconnect/{user_id}"
             
-            response = requests.post(
+            response = self.session.post(
                 url,
                 headers=self.headers,
                 timeout=20  # Railway optimized timeout
@@ -519,7 +528,7 @@ class WhatsAppService:
         try:
             url = f"{self.baileys_url}/force-qr/{user_id}"
             
-            response = requests.post(
+            response = self.session.post(
                 url,
                 headers=self.headers,
                 timeout=45  # Railway optimized timeout
@@ -1,6 +1,7 @@
 import re
 import logging
 from datetime import datetime, date, timedelta
+from functools import lru_cache
 from typing import Optional, Dict, Any
 import pytz
 from config import Config
@@ -78,9 +79,10 @@ def format_date(date_obj: date, format_str: str = '%d/%m/%Y') -> str:
     except (AttributeError, ValueError):
         return ""
 
+@lru_cache(maxsize=None)
 def get_timezone():
     """
-    Get configured timezone
+    Get configured timezone (resolved once and reused)
     """
     return pytz.timezone(Config.TIMEZONE)
 